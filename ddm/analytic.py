@@ -7,7 +7,18 @@
 
 import numpy as np
 
-def analytic_ddm_linbound(a1, b1, a2, b2, teval):
+from . import parameters as param
+
+# Numba is optional.  If it is installed, analytic_ddm_linbound uses a
+# compiled version of the series summation.
+try:
+    import numba
+except ImportError:
+    numba = None
+
+INV_SQRT_2PI = 1/np.sqrt(2*np.pi)
+
+def analytic_ddm_linbound(a1, b1, a2, b2, teval, inv_t=None, t_pow=None, a1sq_over_2t=None, dtype=np.float64):
     '''
     Calculate the reaction time distribution of a Drift Diffusion model
     with linear boundaries, zero drift, and noise = 1.
@@ -17,43 +28,147 @@ def analytic_ddm_linbound(a1, b1, a2, b2, teval):
     The starting point is 0
     teval is the array of time where the reaction time distribution is evaluated
 
+    Optionally, inv_t = 1/teval, t_pow = teval**-1.5, and a1sq_over_2t
+    = a1**2/(2*teval) may be passed if they have already been
+    computed, e.g. when calling this function several times on the same
+    teval.
+
+    dtype is the floating point type used for the computation.  Using
+    np.float32 halves memory traffic but is less precise.  The result
+    is always returned as np.float64.
+
     Return the reaction time distribution of crossing the upper boundary
 
     Reference:
     Anderson, Theodore W. "A modification of the sequential probability ratio test
     to reduce the sample size." The Annals of Mathematical Statistics (1960): 165-197.
     '''
-    # Avoid dividing by zero
-    teval[teval==0] = 1e-30
-    
-    # Change of variables
-    tmp = -2.*((a1-a2)/teval+b1-b2)
+    dtype = np.dtype(dtype)
+    if dtype != np.float64:
+        a1, b1, a2, b2 = (dtype.type(v) for v in (a1, b1, a2, b2))
+        teval = np.asarray(teval, dtype=dtype)
+        inv_t = None if inv_t is None else np.asarray(inv_t, dtype=dtype)
+        t_pow = None if t_pow is None else np.asarray(t_pow, dtype=dtype)
+        a1sq_over_2t = None if a1sq_over_2t is None else np.asarray(a1sq_over_2t, dtype=dtype)
+
+    # Powers of teval.  Avoid dividing by zero without modifying teval.
+    if inv_t is None or t_pow is None:
+        teval_nz = np.maximum(teval, _min_teval(dtype))
+        if inv_t is None:
+            inv_t = 1/teval_nz
+        if t_pow is None:
+            t_pow = teval_nz**-1.5
+    # Both the compiled and the NumPy paths use the a1 part of the
+    # exponent, so compute it here if it wasn't passed.
+    if a1sq_over_2t is None:
+        a1sq_over_2t = 0.5*a1*a1*inv_t
 
     # Initialization
-    nMax     = 100  # Maximum looping number
-    # errbnd   = 1e-7 # Error bound for looping
-    suminc   = 0
-    # checkerr = 0
+    nMax     = 100  # Maximum number of terms in the series
+    errbnd   = 1e-7 # Error bound for the relative increment
+
+    if numba is not None:
+        dist = _analytic_ddm_linbound_nb(dtype.type(a1), dtype.type(b1), dtype.type(a2), dtype.type(b2),
+                                         np.asarray(teval, dtype=dtype), np.asarray(inv_t, dtype=dtype),
+                                         np.asarray(t_pow, dtype=dtype), np.asarray(a1sq_over_2t, dtype=dtype),
+                                         nMax, dtype.type(errbnd))
+        return dist.astype(np.float64, copy=False)
 
+    nChunk   = 8    # Number of terms between convergence checks
+
+    # Change of variables
+    tmp = -2.*((a1-a2)*inv_t+b1-b2)
+
+    # The nth term of the series is E1*((2n+1)*a1-2n*a2) -
+    # E2*((2n+1)*a1-2(n+1)*a2), where E1 = exp(tmp*n*((n+1)*a1-n*a2))
+    # and E2 = exp(tmp*(n+1)*(n*a1-(n+1)*a2)).  The exponents are
+    # quadratic in n, so instead of computing a new exponential for
+    # each term, multiply E1 and E2 by their ratio to the next term.
+    # The ratios are R1 = exp(tmp*(2(n+1)*a1-(2n+1)*a2)) and R2 =
+    # exp(tmp*(2(n+1)*a1-(2n+3)*a2)), which are in turn multiplied by
+    # Q = exp(2*tmp*(a1-a2)) for each term.
+    Q  = np.exp(2*tmp*(a1-a2))
+    E1 = np.ones_like(tmp)
+    R1 = np.exp(tmp*(2*a1-a2))
+    E2 = np.exp(-tmp*a2)
+    R2 = np.exp(tmp*(2*a1-3*a2))
+    suminc = np.zeros_like(tmp)
+    incmax = np.zeros_like(tmp) # Largest increment since the last check
     for n in range(nMax):
         # increment
-        inc = np.exp(tmp*n*((n+1)*a1-n*a2))*((2*n+1)*a1-2*n*a2)-\
-              np.exp(tmp*(n+1)*(n*a1-(n+1)*a2))*((2*n+1)*a1-2*(n+1)*a2)
+        inc = E1*((2*n+1)*a1-2*n*a2) - E2*((2*n+1)*a1-2*(n+1)*a2)
         suminc += inc
-        # Break when the relative increment is low for two consecutive updates
-        # if(max(abs(inc/suminc)) < errbnd):
-        #     checkerr += 1
-        #     if(checkerr == 2):
-        #         break
-        # else:
-        #     checkerr = 0
-
-    # Probability Distribution of reaction time
-    dist = np.exp(-(a1+b1*teval)**2./teval/2)/np.sqrt(2*np.pi)/teval**1.5*suminc
+        np.maximum(incmax, np.abs(inc), out=incmax)
+        # Every nChunk terms, break when every increment since the
+        # last check is low relative to the sum at each time point
+        if (n+1) % nChunk == 0:
+            if np.all(incmax <= errbnd*np.abs(suminc)):
+                break
+            incmax[:] = 0
+        E1 *= R1
+        R1 *= Q
+        E2 *= R2
+        R2 *= Q
+
+    # Probability Distribution of reaction time.  The exponent is
+    # -(a1+b1*teval)**2/teval/2, expanded so that the a1 term can be
+    # shared.
+    dist = np.exp(-a1sq_over_2t - a1*b1 - 0.5*b1*b1*teval)*t_pow*INV_SQRT_2PI*suminc
     dist = dist*(dist>0) # make sure non-negative
-    return dist
+    return dist.astype(np.float64, copy=False)
 
-def analytic_ddm(drift, noise, b, teval, b_slope=0):
+def _min_teval(dtype):
+    '''
+    The value to use in place of t=0, small enough to give a density
+    of zero but large enough that teval**-1.5 doesn't overflow dtype.
+    '''
+    return max(1e-30, np.sqrt(np.finfo(dtype).tiny))
+
+if numba is not None:
+    @numba.njit(cache=True, fastmath=True)
+    def _analytic_ddm_linbound_nb(a1, b1, a2, b2, teval, inv_t, t_pow, a1sq_over_2t, nMax, errbnd):
+        '''
+        Compiled version of analytic_ddm_linbound.
+
+        Rather than evaluating the series for all time points at once,
+        this sums the series separately for each time point in
+        `teval`, so it can stop as soon as that time point converges.
+        '''
+        dist = np.empty_like(teval)
+        for i in range(len(teval)):
+            t = teval[i]
+            # Change of variables
+            tmp = -2.*((a1-a2)*inv_t[i]+b1-b2)
+            # Exponentials are updated by their ratios to the next
+            # term, as in analytic_ddm_linbound.
+            Q  = np.exp(2*tmp*(a1-a2))
+            E1 = 1.
+            R1 = np.exp(tmp*(2*a1-a2))
+            E2 = np.exp(-tmp*a2)
+            R2 = np.exp(tmp*(2*a1-3*a2))
+            suminc = 0.
+            checkerr = 0
+            for n in range(nMax):
+                # increment
+                inc = E1*((2*n+1)*a1-2*n*a2) - E2*((2*n+1)*a1-2*(n+1)*a2)
+                suminc += inc
+                # Break when the relative increment is low for two consecutive updates
+                if abs(inc) <= errbnd*abs(suminc):
+                    checkerr += 1
+                    if checkerr == 2:
+                        break
+                else:
+                    checkerr = 0
+                E1 *= R1
+                R1 *= Q
+                E2 *= R2
+                R2 *= Q
+            # Probability Distribution of reaction time
+            d = np.exp(-a1sq_over_2t[i] - a1*b1 - 0.5*b1*b1*t)*t_pow[i]*INV_SQRT_2PI*suminc
+            dist[i] = d if d > 0 else 0. # make sure non-negative
+        return dist
+
+def analytic_ddm(drift, noise, b, teval, b_slope=0, dtype=None):
     '''
     Calculate the reaction time distribution of a Drift Diffusion model
     Parameters
@@ -64,6 +179,9 @@ def analytic_ddm(drift, noise, b, teval, b_slope=0):
     teval : The array of time points where the reaction time distribution is evaluated
     b_slope : (Optional) If provided, then the upper boundary is B(t) = b + b_slope*t,
               and the lower boundary is B(t) = -b - b_slope*t
+    dtype : (Optional) The floating point type used for the computation.
+            Defaults to the PYDDM_ANALYTIC_DTYPE environment variable,
+            or np.float64 if it is not set.
 
     Return:
     dist_cor : Reaction time distribution at teval for correct trials
@@ -74,11 +192,25 @@ def analytic_ddm(drift, noise, b, teval, b_slope=0):
     drift   /= noise
     b_slope /= noise
 
+    if dtype is None:
+        dtype = param.analytic_dtype
+    dtype = np.dtype(dtype)
+
     # Get valid time points (before two bounds collapsed)
-    teval_valid = teval[b+b_slope*teval>0]
+    teval_valid = teval[b+b_slope*teval>0].astype(dtype, copy=False)
+    b = dtype.type(b)
+
+    # Powers of teval_valid are the same for both boundaries, so only
+    # compute them once.  Avoid dividing by zero.
+    teval_nz = np.maximum(teval_valid, _min_teval(dtype))
+    inv_t = 1/teval_nz
+    t_pow = teval_nz**-1.5
+    a1sq_over_2t = 0.5*b*b*inv_t
 
-    dist_cor = analytic_ddm_linbound(b, -drift+b_slope, -b, -drift-b_slope, teval_valid)
-    dist_err = analytic_ddm_linbound(b,  drift+b_slope, -b,  drift-b_slope, teval_valid)
+    dist_cor = analytic_ddm_linbound(b, -drift+b_slope, -b, -drift-b_slope, teval_valid,
+                                     inv_t=inv_t, t_pow=t_pow, a1sq_over_2t=a1sq_over_2t, dtype=dtype)
+    dist_err = analytic_ddm_linbound(b,  drift+b_slope, -b,  drift-b_slope, teval_valid,
+                                     inv_t=inv_t, t_pow=t_pow, a1sq_over_2t=a1sq_over_2t, dtype=dtype)
 
     # For invalid time points, set the probability to be a very small number
     if len(teval_valid) < len(teval):
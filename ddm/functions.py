@@ -10,6 +10,7 @@ __all__ = ['models_close', 'fit_model', 'fit_adjust_model',
            'set_N_cpus']
 
 import copy
+import logging
 
 import numpy as np
 from scipy.optimize import minimize, basinhopping, differential_evolution, OptimizeResult
@@ -31,6 +32,10 @@ from .models.paranoid_types import Conditions
 
 from .fitresult import FitResult
 
+# Progress of fits is logged at the DEBUG level rather than printed,
+# since printing on every evaluation of the loss function is slow.
+_logger = logging.getLogger(__name__)
+
 # For parallelization support
 _parallel_pool = None # Note: do not change this directly.  Call set_N_cpus() instead.
 #@accepts(Natural1)
@@ -100,7 +105,9 @@ def fit_model(sample,
     descent.  "basin" uses "scipy.optimize.basinhopping" to find an
     optimal solution, which is much slower but also gives better
     results than "simple".  It does not appear to give better results
-    than "differential_evolution".
+    than "differential_evolution".  "de_lbfgs" runs a short, coarse
+    differential evolution and then refines the best point with
+    L-BFGS-B, which needs fewer evaluations for smooth loss functions.
 
     `fitparams` is a dictionary of kwargs to be passed directly to the
     minimization routine for fine-grained low-level control over the
@@ -155,14 +162,22 @@ def fit_adjust_model(sample, model, fitparams=None, method="differential_evoluti
     descent.  "basin" uses "scipy.optimize.basinhopping" to find an
     optimal solution, which is much slower but also gives better
     results than "simple".  It does not appear to give better results
-    than "differential_evolution".  Alternatively, a custom objective
-    function may be used by setting `method` to be a function which
-    accepts the "x_0" parameter (for starting position) and
-    "constraints" (for min and max values).
+    than "differential_evolution".  "de_lbfgs" runs a short, coarse
+    differential evolution and then refines the best point with
+    L-BFGS-B, which needs fewer evaluations for smooth loss functions.
+    Alternatively, a custom objective function may be used by setting
+    `method` to be a function which accepts the "x_0" parameter (for
+    starting position) and "constraints" (for min and max values).
 
     `fitparams` is a dictionary of kwargs to be passed directly to the
     minimization routine for fine-grained low-level control over the
-    optimization.  Normally this should not be needed.  
+    optimization.  Normally this should not be needed.  For
+    "de_lbfgs", these are passed to the differential evolution stage.
+    For "differential_evolution" and "de_lbfgs", passing {"workers":
+    N} evaluates the population on N processes (or one per CPU if N
+    is -1).  This requires pathos, and is ignored if set_N_cpus() has
+    been called.  Alternatively, passing {"vectorized": True}
+    evaluates the whole population in a single call.
 
     `lossfunction` is a subclass of LossFunction representing the
     method to use when calculating the goodness-of-fit.  Pass the
@@ -183,6 +198,9 @@ def fit_adjust_model(sample, model, fitparams=None, method="differential_evoluti
     This function will automatically parallelize if set_N_cpus() has
     been called.
 
+    The loss of each set of parameters is logged to the
+    "ddm.functions" logger at the DEBUG level.
+
     """
     # Disable paranoid if `verify` is False.
     paranoid_state = paranoid_settings.get('enabled')
@@ -193,33 +211,34 @@ def fit_adjust_model(sample, model, fitparams=None, method="differential_evoluti
     # "params".  Create a list of functions to set the value of these
     # parameters, named "setters".
     m = model
-    components_list = [m.get_dependence("drift"),
-                       m.get_dependence("noise"),
-                       m.get_dependence("bound"),
-                       m.get_dependence("IC"),
-                       m.get_dependence("overlay")]
+    components_list = m.dependencies
     required_conditions = list(set([x for l in components_list for x in l.required_conditions]))
     assert 0 < len([1 for component in components_list
                       for param_name in component.required_parameters
                           if isinstance(getattr(component, param_name), Fittable)]), \
            "Models must contain at least one Fittable parameter in order to be fit"
     params = [] # A list of all of the Fittables that were passed.
-    setters = [] # A list of functions which set the value of the corresponding parameter in `params`
+    params_index = {} # Maps the id() of each Fittable to its index in `params`
+    setters = [] # For each parameter in `params`, a list of functions which set its value
     for component in components_list:
         for param_name in component.required_parameters:
             pv = getattr(component, param_name) # Parameter value in the object
             if isinstance(pv, Fittable):
                 # Create a function which sets each parameter in the
-                # list to some value `a` for model `x`.  Note the
+                # list to some value `a` in model `m`.  Note the
                 # default arguments to the function are necessary here
                 # to preserve scope.  Without them, these variables
                 # would be interpreted in the local scope, so they
                 # would be equal to the last value encountered in the
-                # loop.
-                def setter(x,a,pv=pv,component=component,param_name=param_name):
+                # loop.  Since this is called for every evaluation of
+                # the loss function, the component is bound directly
+                # rather than looked up in the model each time.  Use
+                # setattr so that components which forward their
+                # parameters (e.g. OverlayChain) still do so.
+                def setter(a,pv=pv,component=component,param_name=param_name):
                     if not isinstance(a, Fittable):
                         a = pv.make_fitted(a)
-                    setattr(x.get_dependence(component.depname), param_name, a)
+                    setattr(component, param_name, a)
                     # Return the fitted instance so we can chain it.
                     # This way, if the same Fittable object is passed,
                     # the same Fitted object will be in both places in
@@ -228,29 +247,30 @@ def fit_adjust_model(sample, model, fitparams=None, method="differential_evoluti
                 
                 # If we have the same Fittable object in two different
                 # components inside the model, we only want the Fittable
-                # object in the list "params" once, but we want the setter
+                # object in the list "params" once, but we want the setters
                 # to update both.
-                if id(pv) in map(id, params):
-                    pind = list(map(id, params)).index(id(pv))
-                    oldsetter = setters[pind]
-                    # This is a hack way of executing two functions in
-                    # a single function call while passing forward the
-                    # same argument object (not just the same argument
-                    # value)
-                    newsetter = lambda x,a,setter=setter,oldsetter=oldsetter : oldsetter(x,setter(x,a)) 
-                    setters[pind] = newsetter
+                if id(pv) in params_index:
+                    setters[params_index[id(pv)]].append(setter)
                 else: # This setter is unique (so far)
+                    params_index[id(pv)] = len(params)
                     params.append(pv)
-                    setters.append(setter)
+                    setters.append([setter])
+    # Run each setter in the list `fns`, passing forward the same
+    # Fitted object (not just the same value) from one setter to the
+    # next.
+    def apply_setters(a, fns):
+        for f in fns:
+            a = f(a)
+        return a
                 
     # And now get rid of the Fittables, replacing them with the
     # default values.  Simultaneously, create a list to pass to the
     # solver.
     x_0 = []
     constraints = [] # List of (min, max) tuples.  min/max=None if no constraint.
-    for p,s in zip(params, setters):
+    for p,fns in zip(params, setters):
         default = p.default()
-        s(m, default)
+        apply_setters(default, fns)
         minval = p.minval if p.minval > -np.inf else None
         maxval = p.maxval if p.maxval < np.inf else None
         constraints.append((minval, maxval))
@@ -259,11 +279,26 @@ def fit_adjust_model(sample, model, fitparams=None, method="differential_evoluti
     lf = lossfunction(sample, required_conditions=required_conditions,
                       T_dur=m.T_dur, dt=m.dt,
                       nparams=len(params), samplesize=len(sample))
+    # Optimizers often evaluate the loss function at (nearly) the same
+    # point multiple times, so save the loss for each point, rounded
+    # to 10 decimal places, to avoid solving the model again.  Bound
+    # the size of the cache to keep memory usage reasonable.  Before
+    # checking the cache, check whether the point is bit-for-bit
+    # identical to the previous one, which is cheaper.
+    _cache = {}
+    _last = [None, None] # (Bytes of the last point, its loss)
     # A function for the solver to minimize.  Since the model is in
     # this scope, we can make use of it by using, for example, the
     # model `m` defined previously.
     def _fit_model(xs):
-        for x,p,s in zip(xs, params, setters):
+        last_key = np.asarray(xs, dtype=float).tobytes()
+        if last_key == _last[0]:
+            return _last[1]
+        key = tuple(np.round(xs, 10))
+        if key in _cache:
+            _last[0], _last[1] = last_key, _cache[key]
+            return _cache[key]
+        for x,p,fns in zip(xs, params, setters):
             # Sometimes the numpy optimizers will ignore bounds up to
             # floating point errors, i.e. if your upper bound is 1,
             # they will give 1.000000000001.  This fixes that problem
@@ -274,15 +309,24 @@ def fit_adjust_model(sample, model, fitparams=None, method="differential_evoluti
             if x < p.minval:
                 print("Warning: optimizer went out of bounds.  Setting %f to %f" % (x, p.minval))
                 x = p.minval
-            s(m, x)
+            apply_setters(x, fns)
         lossf = lf.loss(m)
-        print(repr(m), "loss="+str(lossf))
+        _logger.debug("%r loss=%s", m, lossf)
+        if len(_cache) > 4096:
+            _cache.clear()
+        _cache[key] = lossf
+        _last[0], _last[1] = last_key, lossf
         return lossf
+    # The same, but for an entire population of parameters, with one
+    # set of parameters in each column of `X`.  Returns one loss per
+    # column.
+    def _fit_model_vec(X):
+        return np.asarray([_fit_model(xs) for xs in np.asarray(X).T])
     # Cast to a dictionary if necessary
     if fitparams is None:
         fitparams = {}
     # Run the solver
-    print(x_0)
+    _logger.debug("Initial parameters: %s", x_0)
     if method == "simple":
         x_fit = minimize(_fit_model, x_0, bounds=constraints)
         assert x_fit.success, "Fit failed: %s" % x_fit.message
@@ -290,8 +334,58 @@ def fit_adjust_model(sample, model, fitparams=None, method="differential_evoluti
         x_fit = minimize(_fit_model, x_0, method='Nelder-Mead')
     elif method == "basin":
         x_fit = basinhopping(_fit_model, x_0, minimizer_kwargs={"bounds" : constraints, "method" : "TNC"}, disp=True, **fitparams)
-    elif method == "differential_evolution":
-        x_fit = differential_evolution(_fit_model, constraints, disp=True, **fitparams)
+    elif method in ["differential_evolution", "de_lbfgs"]:
+        # If "workers" is given, evaluate the population in parallel.
+        # _fit_model is a closure, so it can't be pickled by the
+        # multiprocessing pool that scipy would create.  Instead, use
+        # a pathos pool, which uses dill.  If set_N_cpus() has been
+        # called, the existing pool is used to parallelize across
+        # conditions instead, so drop "workers" rather than letting
+        # scipy create a second pool.
+        fitparams = dict(fitparams)
+        if _parallel_pool is not None and "workers" in fitparams:
+            _logger.warning("Ignoring workers=%r because set_N_cpus() has been called",
+                            fitparams.pop("workers"))
+        workers = fitparams.get("workers", 1)
+        de_pool = None
+        if isinstance(workers, int) and workers != 1:
+            try:
+                import pathos
+            except ImportError:
+                raise ImportError("Parallel support requires pathos.  Please install pathos.")
+            de_pool = pathos.pools._ProcessPool(workers if workers > 0 else None)
+            fitparams["workers"] = de_pool.map
+        if fitparams.get("workers", 1) != 1:
+            fitparams.setdefault("updating", "deferred")
+        # If "vectorized" is given, scipy passes the whole population
+        # at once.  This only applies in serial, since scipy ignores
+        # "vectorized" if "workers" is given.
+        objective = _fit_model
+        if fitparams.get("vectorized", False):
+            fitparams.setdefault("updating", "deferred")
+            if fitparams.get("workers", 1) == 1:
+                objective = _fit_model_vec
+        try:
+            if method == "differential_evolution":
+                x_fit = differential_evolution(objective, constraints, disp=True, **fitparams)
+            else:
+                # Locate the basin of the global minimum with a coarse
+                # differential evolution, and then find the minimum
+                # using L-BFGS-B starting from the best point.
+                de_params = {"maxiter": 30, "popsize": 10, "tol": 1e-3, "polish": False}
+                de_params.update(fitparams)
+                x_de = differential_evolution(objective, constraints, disp=True, **de_params)
+                x_fit = minimize(_fit_model, x_de.x, method='L-BFGS-B', bounds=constraints,
+                                 options={'ftol': 1e-7, 'gtol': 1e-7})
+                # Fall back to the differential evolution result if
+                # L-BFGS-B fails or makes it worse.
+                if not x_fit.success or x_fit.fun > x_de.fun:
+                    _logger.warning("L-BFGS-B did not improve on differential evolution: %s", x_fit.message)
+                    x_fit = x_de
+        finally:
+            if de_pool is not None:
+                de_pool.close()
+                de_pool.join()
     elif method == "hillclimb":
         x_fit = evolution_strategy(_fit_model, x_0, **fitparams)
     elif callable(method):
@@ -302,9 +396,9 @@ def fit_adjust_model(sample, model, fitparams=None, method="differential_evoluti
                     nparams=len(params), samplesize=len(sample),
                     mess=(x_fit.message if "message" in x_fit.__dict__ else ""))
     m.fitresult = res
-    print("Params", x_fit.x, "gave", x_fit.fun)
-    for x,s in zip(x_fit.x, setters):
-        s(m, x)
+    _logger.debug("Params %s gave %s", x_fit.x, x_fit.fun)
+    for x,fns in zip(x_fit.x, setters):
+        apply_setters(x, fns)
     if paranoid_state and not verify:
         paranoid_settings.set(enabled=True)
     return m
@@ -344,8 +438,13 @@ def evolution_strategy(fitness, x_0, mu=1, lmbda=3, copyparents=True, mutate_var
     
     # Mutation function: with a probability of `mutate_prob`, add a
     # uniform gaussian random variable multiplied by the current value
-    # of the parameter, with variance `mutate_var`.
-    mutate = lambda x : [e+np.random.normal(0, mutate_var) if np.random.random()<mutate_prob else e for e in x]
+    # of the parameter, with variance `mutate_var`.  The random numbers
+    # for all elements are drawn at once.
+    def mutate(x):
+        out = np.array(x, dtype=float)
+        mask = np.random.random(len(out)) < mutate_prob
+        out[mask] += np.random.normal(0, mutate_var, np.sum(mask))
+        return out.tolist()
     # Set up the initial population.  We make the initial population
     # by mutating X_0.  This is not good for explorative search but is
     # good for exploitative search.
@@ -497,19 +596,39 @@ def solve_partial_conditions(model, sample=None, conditions=None, method=None):
                 vs = [vs]
             cond_combs = [cc + [v] for cc in cond_combs for v in vs]
         samp = Sample.from_numpy_array(np.asarray(cond_combs), all_conds)
-    model_corr = 0*model.t_domain()
-    model_err = 0*model.t_domain()
+    nbins = len(model.t_domain())
+    model_corr = np.zeros(nbins)
+    model_err = np.zeros(nbins)
+    tmp_buf = np.empty(nbins) # Scratch space for weighting each pdf
     model_undec = -1 # Set to dummy value -1 so we can detect this in our loop
     # If we have an overlay, this function should not calculate the
     # (incorrect) undecided probability
     if not isinstance(model.get_dependence("overlay"), OverlayNone):
         model_undec = None
     all_conds = solve_all_conditions(model, samp, conditions=conditions, method=method)
-    for conds in samp.condition_combinations(required_conditions=model.required_conditions):
-        subset = samp.subset(**conds)
-        sol = all_conds[frozenset(conds.items())]
-        model_corr += len(subset)/len(samp)*sol.pdf_corr()
-        model_err += len(subset)/len(samp)*sol.pdf_err()
+    # Count the number of trials with each combination of conditions
+    # in a single pass through the sample, rather than taking a subset
+    # of the sample for each combination.
+    names = [n for n in samp.condition_names() if n in model.required_conditions]
+    counts = {}
+    if len(names) == 0:
+        counts[frozenset()] = len(samp)
+    else:
+        for i in range(3 if samp.undecided > 0 else 2): # Correct, error, and undecided
+            for vals in zip(*[samp.conditions[n][i] for n in names]):
+                key = frozenset(zip(names, vals))
+                counts[key] = counts.get(key, 0) + 1
+    for key,count in counts.items():
+        # Combinations of conditions with only undecided trials are
+        # not solved
+        if key not in all_conds:
+            continue
+        sol = all_conds[key]
+        w = count/len(samp)
+        np.multiply(sol.pdf_corr(), w, out=tmp_buf)
+        model_corr += tmp_buf
+        np.multiply(sol.pdf_err(), w, out=tmp_buf)
+        model_err += tmp_buf
         # We can't get the size of the undecided pdf until we have a
         # specific set of conditions.  Once we do, if the simulation
         # method doesn't support an undecided probability, set it to
@@ -518,9 +637,9 @@ def solve_partial_conditions(model, sample=None, conditions=None, method=None):
         # bound depends on a parameter.)  If they are ever not the
         # same size, set it to None rather than trying to align them.
         if sol.undec is not None and isinstance(model_undec, int) and model_undec == -1:
-            model_undec = len(subset)/len(samp)*sol.pdf_undec()
+            model_undec = w*sol.pdf_undec()
         if sol.undec is not None and model_undec is not None and len(model_undec) == len(sol.undec):
-            model_undec += len(subset)/len(samp)*sol.pdf_undec()
+            model_undec += w*sol.pdf_undec()
         else:
             model_undec = None
     return Solution(model_corr*model.dt, model_err*model.dt, model, conditions, pdf_undec=model_undec)
@@ -529,13 +648,8 @@ def solve_partial_conditions(model, sample=None, conditions=None, method=None):
 @returns(Boolean)
 def hit_boundary(model):
     """Returns True if any Fitted objects are close to their min/max value"""
-    components_list = [model.get_dependence("drift"),
-                       model.get_dependence("noise"),
-                       model.get_dependence("bound"),
-                       model.get_dependence("IC"),
-                       model.get_dependence("overlay")]
     hit = False
-    for component in components_list:
+    for component in model.dependencies:
         for param_name in component.required_parameters:
             pv = getattr(component, param_name) # Parameter value in the object
             if isinstance(pv, Fitted):
@@ -570,18 +684,18 @@ def display_model(model, print_output=True):
     `model` should be any Model object.  Prints a description of the
     model, and does not return anything.
     """
-    OUT = ""
+    parts = []
     assert isinstance(model, Model), "Invalid model"
     # Separate the code to display a single component so we can reuse
     # it to display the components of chains (e.g. OverlayChain).
     def display_component(component, prefix=""):
-        OUT = ""
-        OUT += prefix+"%s" % component.name + "\n"
+        parts = []
+        parts.append(prefix+"%s" % component.name + "\n")
         fixed = []
         fitted = []
         fittable = []
         if len(component.required_parameters) == 0:
-            OUT += prefix+"(No parameters)" + "\n"
+            parts.append(prefix+"(No parameters)" + "\n")
         for param_name in component.required_parameters:
             pv = getattr(component, param_name) # Parameter value in the object
             if isinstance(pv, Fitted):
@@ -595,20 +709,21 @@ def display_model(model, print_output=True):
                 fixed.append(prefix+"- %s: %f" % (param_name, pv))
         for t,vs in [("Fixed", fixed), ("Fitted", fitted), ("Fittable", fittable)]:
             if len(vs) > 0:
-                OUT += prefix+t+" parameters:" + "\n"
+                parts.append(prefix+t+" parameters:" + "\n")
                 for v in vs:
-                    OUT += v + "\n"
-        return OUT
+                    parts.append(v + "\n")
+        return "".join(parts)
     # Start displaying the model information
-    OUT += ("Model %s information:\n" % model.name) if model.name != "" else "Model information:" + "\n"
+    parts.append(("Model %s information:\n" % model.name) if model.name != "" else "Model information:" + "\n")
     for component in model.dependencies:
-        OUT += "%s component %s:" % (component.depname, type(component).__name__) + "\n"
+        parts.append("%s component %s:" % (component.depname, type(component).__name__) + "\n")
         if isinstance(component, OverlayChain):
             for o in component.overlays:
-                OUT += "    %s component %s:" % (o.depname, type(o).__name__) + "\n"
-                OUT += display_component(o, prefix="        ")
+                parts.append("    %s component %s:" % (o.depname, type(o).__name__) + "\n")
+                parts.append(display_component(o, prefix="        "))
         else:
-            OUT += display_component(component, prefix="    ")
+            parts.append(display_component(component, prefix="    "))
+    OUT = "".join(parts)
     if not print_output:
         return OUT
     else:
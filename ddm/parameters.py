@@ -7,7 +7,14 @@
 # Default simulaiton parameters.  These can be overridden by user
 # code on a per-model basis.
 
+import os
+
 # Parameters.
 dx = .005 #0.008 # grid size
 T_dur = 2. # [s] Duration of simulation
 dt = .002 #0.005 # [s] Time-step.
+
+# Floating point type for analytical solutions.  Set the environment
+# variable PYDDM_ANALYTIC_DTYPE to "float32" to trade precision for
+# speed.
+analytic_dtype = os.environ.get("PYDDM_ANALYTIC_DTYPE", "float64")
@@ -3,6 +3,7 @@ from unittest import TestCase, main
 import numpy as np
 from math import fsum
 import pandas
+from scipy.optimize import OptimizeResult
 
 import ddm
 
@@ -133,6 +134,47 @@ class TestFit(TestCase):
             plot_compare_solutions(s, sfit)
             plt.show()
         _verify_param_match("drift", "drift", m, mfit)
+    def test_fit_drift_de_lbfgs(self):
+        """A simple one-parameter fit using coarse differential evolution followed by L-BFGS-B"""
+        m = ddm.Model(name="DDM", drift=ddm.DriftConstant(drift=2))
+        s = m.solve()
+        sample = s.resample(10000)
+        mfit = ddm.Model(name="DDM", drift=ddm.DriftConstant(drift=ddm.Fittable(minval=0, maxval=10)))
+        ddm.fit_adjust_model(model=mfit, sample=sample, method="de_lbfgs")
+        _verify_param_match("drift", "drift", m, mfit)
+    def test_fit_loss_cache(self):
+        """Repeated points are not solved again, and the fitted values are still applied"""
+        calls = []
+        class LossCounted(ddm.LossSquaredError):
+            name = "Counted squared error"
+            def loss(self, model):
+                calls.append(model.get_dependence("drift").drift)
+                return ddm.LossSquaredError.loss(self, model)
+        def repeat_points(objective, x_0, constraints):
+            f = objective([1.])
+            assert objective([1.]) == f # Identical to the last point
+            objective([3.])
+            assert objective([1.+1e-12]) == f # Same point after rounding
+            return OptimizeResult(x=np.asarray([1.+1e-12]), fun=f, success=True)
+        s = ddm.Model(drift=ddm.DriftConstant(drift=1)).solve().resample(1000)
+        mfit = ddm.Model(drift=ddm.DriftConstant(drift=ddm.Fittable(minval=0, maxval=5)))
+        ddm.fit_adjust_model(model=mfit, sample=s, method=repeat_points, lossfunction=LossCounted)
+        assert calls == [1., 3.]
+        # The model was last solved at 3, but the fitted value is 1
+        assert mfit.get_dependence("drift").drift == 1.+1e-12
+    def test_fit_overlay_chain(self):
+        """Fit a parameter of an overlay inside an OverlayChain"""
+        m = ddm.Model(name="DDM", drift=ddm.DriftConstant(drift=2),
+                      overlay=ddm.OverlayChain(overlays=[ddm.OverlayNonDecision(nondectime=.3),
+                                                         ddm.OverlayPoissonMixture(pmixturecoef=.05, rate=1)]))
+        s = m.solve()
+        sample = s.resample(10000)
+        mfit = ddm.Model(name="DDM", drift=ddm.DriftConstant(drift=2),
+                         overlay=ddm.OverlayChain(overlays=[ddm.OverlayNonDecision(nondectime=ddm.Fittable(minval=0, maxval=.6)),
+                                                            ddm.OverlayPoissonMixture(pmixturecoef=.05, rate=1)]))
+        ddm.fit_adjust_model(model=mfit, sample=sample)
+        _verify_param_match("overlay", "nondectime", m, mfit)
+        assert isinstance(mfit.get_dependence("overlay").overlays[0].nondectime, ddm.Fitted)
     def test_fit_with_condition(self):
         """A simple one-parameter fit with conditions"""
         m = self.cond_m
@@ -151,6 +193,32 @@ class TestFit(TestCase):
         ddm.set_N_cpus(2)
         self.test_fit_with_condition()
         ddm.set_N_cpus(1)
+    def test_fit_with_condition_workers(self):
+        """A simple one-parameter fit with conditions, with the population evaluated in parallel"""
+        m = self.cond_m
+        s = self.cond_s
+        mfit = ddm.Model(drift=self.DriftCond(param=ddm.Fittable(minval=.1, maxval=3)))
+        ddm.fit_adjust_model(model=mfit, sample=s, fitparams={"workers": 2})
+        _verify_param_match("drift", "param", m, mfit)
+    def test_fit_with_condition_workers_parallel(self):
+        """Passing workers after set_N_cpus() ignores workers"""
+        m = self.cond_m
+        s = self.cond_s
+        mfit = ddm.Model(drift=self.DriftCond(param=ddm.Fittable(minval=.1, maxval=3)))
+        ddm.set_N_cpus(2)
+        try:
+            with self.assertLogs("ddm.functions", level="WARNING"):
+                ddm.fit_adjust_model(model=mfit, sample=s, fitparams={"workers": 2})
+        finally:
+            ddm.set_N_cpus(1)
+        _verify_param_match("drift", "param", m, mfit)
+    def test_fit_with_condition_vectorized(self):
+        """A simple one-parameter fit with conditions, evaluating the population all at once"""
+        m = self.cond_m
+        s = self.cond_s
+        mfit = ddm.Model(drift=self.DriftCond(param=ddm.Fittable(minval=.1, maxval=3)))
+        ddm.fit_adjust_model(model=mfit, sample=s, fitparams={"vectorized": True})
+        _verify_param_match("drift", "param", m, mfit)
     def test_double_fit(self):
         """Fit different parameters in the same (or a different) model using a single Fittable object"""
         class NoiseDouble(ddm.Noise):
@@ -594,6 +594,37 @@ class TestMisc(TestCase):
         m = ddm.Model(bound=b, T_dur=2)
         s = m.solve()
         assert len(s.pdf_corr()) == len(m.t_domain())
+    def test_analytic_float32(self):
+        """Single-precision analytic solutions should be close to double precision"""
+        from ddm.analytic import analytic_ddm
+        t = ddm.Model(T_dur=2).t_domain()
+        for b_slope in [0, -.4]:
+            d64 = analytic_ddm(1.5, 1, 1, t, b_slope=b_slope)
+            d32 = analytic_ddm(1.5, 1, 1, t, b_slope=b_slope, dtype=np.float32)
+            for p64, p32 in zip(d64, d32):
+                assert p32.dtype == np.float64
+                assert np.max(np.abs(p64 - p32)) < 1e-4 * np.max(p64)
+    def test_analytic_numba_vs_numpy(self):
+        """The compiled and NumPy analytic solutions should agree"""
+        import ddm.analytic
+        from ddm.analytic import analytic_ddm
+        if ddm.analytic.numba is None:
+            self.skipTest("numba is not installed")
+        t = ddm.Model(T_dur=2).t_domain()
+        params = [(drift, b, b_slope) for drift in [0, .8, -2]
+                                      for b in [.5, 1, 1.5]
+                                      for b_slope in [0, .3, -.4]] # Including a collapsing bound
+        sols_nb = [analytic_ddm(drift, 1, b, t, b_slope=b_slope) for drift,b,b_slope in params]
+        numba = ddm.analytic.numba
+        ddm.analytic.numba = None
+        try:
+            sols_np = [analytic_ddm(drift, 1, b, t, b_slope=b_slope) for drift,b,b_slope in params]
+        finally:
+            ddm.analytic.numba = numba
+        for (drift,b,b_slope), s_nb, s_np in zip(params, sols_nb, sols_np):
+            for p_nb, p_np in zip(s_nb, s_np):
+                assert np.max(np.abs(p_nb - p_np)) < 1e-6 * np.max(p_nb) + 1e-12, \
+                    "Mismatch for drift=%f, b=%f, b_slope=%f" % (drift, b, b_slope)
         
 
 